@@ -2,13 +2,19 @@
 """
 backfill_risk.py - FIXED
 Stops backfilling at 'Yesterday' to avoid conflicting with Live 'Today' data.
+--days, --include-today and --stats change the window and the USGS stat fallbacks.
 """
 
+import argparse
+import functools
+import numpy as np
 import pandas as pd
 import requests
 import os
-import csv
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline_common import cached_get, loads_json, write_if_changed
+from risk_core import DRIVERS, LEVELS, SCORE_CONFIG, tiered_array
 
 # --- CONFIG ---
 DAYS_BACK = 90
@@ -16,131 +22,184 @@ ST_LOUIS_SITE = "07010000"
 OUT_FILE = "data/history/risk_daily.csv"
 RAIL_FILE = "data/history/rail_weekly.csv"
 BARGE_FILE = "data/history/barge_locks27_weekly.csv"
-
-def fetch_river_history():
+USGS_DV_URL = "https://waterservices.usgs.gov/nwis/dv/"
+STATS_TO_TRY = ["00003", "00002", "00001"] # Mean, Min, Max
+CACHE_TTL = 3600  # daily values; an hour-old copy is as good as a new one
+
+# Shared by the concurrent stat probes so connections are pooled
+SESSION = requests.Session()
+
+def fetch_stat_history(stat, days_back=DAYS_BACK):
+    params = {
+        "format": "json",
+        "sites": ST_LOUIS_SITE,
+        "period": f"P{days_back + 20}D",
+        "parameterCd": "00065",
+        "statCd": stat
+    }
+    body, _ = cached_get(SESSION, USGS_DV_URL, params, ttl=CACHE_TTL, timeout=30)
+    data = loads_json(body)
+    if not data.get('value', {}).get('timeSeries'): return {}
+
+    ts = data['value']['timeSeries'][0]['values'][0]['value']
+    return {p['dateTime'][:10]: float(p['value']) for p in ts}
+
+@functools.lru_cache(maxsize=1)
+def fetch_river_history(stats=tuple(STATS_TO_TRY), days_back=DAYS_BACK):
+    """
+    Probe all stats concurrently, but still prefer them in the given order:
+    a lower-priority result is only used once every stat ahead of it came back empty.
+    Memoized per process; across processes the HTTP cache serves reruns within CACHE_TTL.
+    Callers must treat the returned dict as read-only.
+    """
     print("Fetching USGS river history...")
-    url = "https://waterservices.usgs.gov/nwis/dv/"
-    stats_to_try = ["00003", "00002", "00001"] # Mean, Min, Max
-    
-    for stat in stats_to_try:
-        params = {
-            "format": "json",
-            "sites": ST_LOUIS_SITE,
-            "period": f"P{DAYS_BACK + 20}D",
-            "parameterCd": "00065",
-            "statCd": stat
-        }
-        try:
-            r = requests.get(url, params=params, timeout=30)
-            if r.status_code != 200: continue
-            data = r.json()
-            if not data.get('value', {}).get('timeSeries'): continue
-                
-            hist = {}
-            ts = data['value']['timeSeries'][0]['values'][0]['value']
-            for p in ts:
-                hist[p['dateTime'][:10]] = float(p['value'])
-            print(f"  Found {len(hist)} days using stat {stat}")
-            return hist
-        except: continue
-    return {}
-
-def get_as_of(df, date_str, val_col):
-    if df.empty: return 0.0
-    past = df[df['week_end_date'] <= date_str]
-    if past.empty: return float(df.iloc[0][val_col])
-    return float(past.iloc[-1][val_col])
-
-def compute_daily_risk(target_date, river_hist, rail_df, barge_df):
-    date_s = target_date.strftime("%Y-%m-%d")
+    ex = ThreadPoolExecutor(max_workers=len(stats))
+    futures = [(stat, ex.submit(fetch_stat_history, stat, days_back)) for stat in stats]
+    try:
+        for stat, fut in futures:
+            try:
+                hist = fut.result()
+            except Exception:
+                continue
+            if hist:
+                print(f"  Found {len(hist)} days using stat {stat}")
+                return hist
+        return {}
+    finally:
+        # Don't wait on the slower fallbacks once we have an answer
+        ex.shutdown(wait=False, cancel_futures=True)
+
+def weekly_series(df, val_col):
+    """Date-indexed, ascending Series of val_col for vectorized as-of lookups."""
+    if df.empty or val_col not in df.columns:
+        return pd.Series(dtype="float64")
+    s = pd.Series(
+        pd.to_numeric(df[val_col], errors="coerce").to_numpy(),
+        index=pd.to_datetime(df['week_end_date'], errors="coerce"),
+    )
+    s = s[s.index.notna()]
+    s = s[~s.index.duplicated(keep="last")]
+    return s.sort_index()
+
+def as_of(series, dates):
+    """
+    Value of the last week ending on or before each date.
+    Dates before the first week fall back to the first value; empty -> 0.0.
+    """
+    if series.empty: return np.zeros(len(dates))
+    # Binary search on the sorted weeks; -1 (before the first week) clamps to 0
+    idx = series.index.searchsorted(dates, side="right") - 1
+    return series.to_numpy()[np.maximum(idx, 0)]
+
+# Label lookups for the integer level and driver codes; thresholds live in risk_core
+LEVEL_LABELS = np.array(LEVELS)
+PRIMARY_LABELS = np.array(("none",) + DRIVERS)
+
+def compute_daily_risk(r_val, r_delta, rail_delta, barge_delta, cfg=SCORE_CONFIG):
+    """
+    Score every day of the window at once. Inputs are float arrays of one shape,
+    e.g. (days,) or (sites, days); scoring stays in small integer codes and is
+    only mapped to labels at the end.
+    """
+    has_river = ~np.isnan(r_val)
+    r_score = (tiered_array(r_delta, cfg["river_drop_7d"], above=False)
+               + tiered_array(r_val, cfg["river_low_stage"], above=False)) * has_river
+    rr_score = tiered_array(rail_delta, cfg["rail_dwell_4w"], above=True)
+    b_score = tiered_array(barge_delta, cfg["barge_drop_4w"], above=False)
+
+    scores = np.stack([r_score, rr_score, b_score]).astype(np.int16)
+    total = np.minimum(cfg["cap"], scores.sum(axis=0))
+    moderate, critical = cfg["level_cuts"]
+    level_code = (total > moderate).astype(np.int8) + (total > critical)
+    # argmax keeps the first driver on ties, same as max() over the ordered list;
+    # code 0 is "none" when no driver scored
+    primary_code = np.where(scores.max(axis=0) > 0, scores.argmax(axis=0) + 1, 0)
+
+    return total, LEVEL_LABELS[level_code], PRIMARY_LABELS[primary_code]
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Backfill data/history/risk_daily.csv")
+    ap.add_argument("--days", type=int, default=DAYS_BACK, help="days of history to write")
+    ap.add_argument("--include-today", action="store_true",
+                    help="end the window at today instead of yesterday (live runs own today)")
+    ap.add_argument("--stats", default=",".join(STATS_TO_TRY),
+                    help="USGS statCd values to try, in priority order")
+    args = ap.parse_args(argv)
+    if args.days < 1:
+        ap.error("--days must be at least 1")
+    args.stats = tuple(s.strip() for s in args.stats.split(",") if s.strip())
+    if not args.stats:
+        ap.error("--stats needs at least one statCd")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    river_hist = fetch_river_history(args.stats, args.days)
     
-    # RIVER
-    r_val = river_hist.get(date_s)
-    prev_dt = target_date - timedelta(days=7)
-    r_prev = river_hist.get(prev_dt.strftime("%Y-%m-%d"))
-    r_delta = (r_val - r_prev) if (r_val is not None and r_prev is not None) else 0.0
-    
-    # RAIL
-    curr_rail = get_as_of(rail_df, date_s, 'terminal_dwell_hours')
-    past_rail = get_as_of(rail_df, (target_date - timedelta(days=28)).strftime("%Y-%m-%d"), 'terminal_dwell_hours')
-    rail_delta = curr_rail - past_rail
-
-    # BARGE
-    curr_barge = get_as_of(barge_df, date_s, 'total_barges')
-    past_barge = get_as_of(barge_df, (target_date - timedelta(days=28)).strftime("%Y-%m-%d"), 'total_barges')
-    barge_delta = curr_barge - past_barge
-
-    # SCORE
-    drivers = []
-    
-    r_score = 0
-    if r_val is not None:
-        if r_delta < -2.0: r_score += 20
-        if r_val < 0.0: r_score += 20
-        if r_score > 0: drivers.append(("river", r_score))
-
-    rr_score = 0
-    if rail_delta > 2.0: rr_score += 30
-    elif rail_delta > 0.5: rr_score += 15
-    if rr_score > 0: drivers.append(("rail", rr_score))
-
-    b_score = 0
-    if barge_delta < -50: b_score += 30
-    elif barge_delta < -20: b_score += 15
-    if b_score > 0: drivers.append(("barge", b_score))
-
-    total = min(100, r_score + rr_score + b_score)
-    level = "LOW"
-    if total > 70: level = "CRITICAL"
-    elif total > 40: level = "MODERATE"
-    primary = max(drivers, key=lambda x: x[1])[0] if drivers else "none"
-
-    return total, level, primary
-
-def main():
-    river_hist = fetch_river_history()
-    
-    # Load support files
+    # Load support files; only the columns scored here, with dtypes given up front
     rail_df = pd.DataFrame()
     if os.path.exists(RAIL_FILE):
         try: 
-            rail_df = pd.read_csv(RAIL_FILE)
+            rail_df = pd.read_csv(
+                RAIL_FILE,
+                usecols=lambda c: c in ('week_end_date', 'carrier', 'terminal_dwell_hours'),
+                dtype={'carrier': 'category', 'terminal_dwell_hours': 'float64'},
+            )
             if 'carrier' in rail_df.columns:
-                rail_df = rail_df[rail_df['carrier'] == 'UP'].sort_values('week_end_date')
+                rail_df = rail_df[rail_df['carrier'] == 'UP']
         except: pass
 
     barge_df = pd.DataFrame()
     if os.path.exists(BARGE_FILE):
         try:
-            barge_df = pd.read_csv(BARGE_FILE).sort_values('week_end_date')
-            if 'total_barges' not in barge_df.columns and 'total_tons' in barge_df.columns:
-                barge_df['total_barges'] = barge_df['total_tons']
+            barge_df = pd.read_csv(
+                BARGE_FILE,
+                usecols=lambda c: c in ('week_end_date', 'total_barges', 'total_tons'),
+                dtype={'total_barges': 'float64', 'total_tons': 'float64'},
+            )
+            # Older rows carry the same count under total_tons
+            if 'total_tons' in barge_df.columns:
+                legacy = barge_df.pop('total_tons')
+                barge_df['total_barges'] = barge_df.get('total_barges', legacy).fillna(legacy)
         except: pass
 
-    rows = []
-    # Stop at YESTERDAY (Days 1 to 90)
-    # Day 0 is Today, we skip it.
-    today = datetime.now()
-    print(f"Backfilling history (Stopping before today)...")
-    
-    for i in range(1, DAYS_BACK + 1):
-        d = today - timedelta(days=i)
-        res = compute_daily_risk(d, river_hist, rail_df, barge_df)
-        if res:
-            score, level, primary = res
-            ts = d.replace(hour=12, minute=0).isoformat() + "Z"
-            rows.append([ts, score, level, primary])
-
-    # Sort by date ascending
-    rows.sort(key=lambda x: x[0])
-
-    os.makedirs(os.path.dirname(OUT_FILE), exist_ok=True)
-    with open(OUT_FILE, "w", newline="") as f:
-        w = csv.writer(f)
-        w.writerow(["timestamp_utc", "risk_score", "risk_level", "primary_driver"])
-        w.writerows(rows)
+    # Stop at YESTERDAY (Days 1 to 90) unless asked otherwise.
+    # Day 0 is Today, normally left to the live generate_risk run.
+    today = pd.Timestamp.now().normalize()
+    end = today if args.include_today else today - pd.Timedelta(days=1)
+    dates = pd.date_range(end=end, periods=args.days)
+    lag7 = dates - pd.Timedelta(days=7)
+    lag28 = dates - pd.Timedelta(days=28)
+    print(f"Backfilling {args.days} days (through {end.date()})...")
+
+    # All lookups for the window are resolved in one vectorized pass per series
+    river = pd.Series(river_hist, dtype="float64")
+    river.index = pd.to_datetime(river.index, format="%Y-%m-%d")
+    r_val = river.reindex(dates).to_numpy()
+    r_prev = river.reindex(lag7).to_numpy()
+    r_delta = np.where(np.isnan(r_val) | np.isnan(r_prev), 0.0, r_val - r_prev)
+
+    rail = weekly_series(rail_df, 'terminal_dwell_hours')
+    rail_delta = as_of(rail, dates) - as_of(rail, lag28)
+    barge = weekly_series(barge_df, 'total_barges')
+    barge_delta = as_of(barge, dates) - as_of(barge, lag28)
+
+    total, level, primary = compute_daily_risk(r_val, r_delta, rail_delta, barge_delta)
+    # Fixed noon stamps. Before the vectorized rewrite, replace(hour=12) kept the
+    # run's minutes and microseconds (…T12:00:46.808966Z); these sort the same
+    # and no longer change with every rerun
+    out = pd.DataFrame({
+        "timestamp_utc": dates.strftime("%Y-%m-%dT12:00:00Z"),
+        "risk_score": total,
+        "risk_level": level,
+        "primary_driver": primary,
+    })
+
+    # Atomic, and untouched when a rerun recomputes the same days
+    write_if_changed(OUT_FILE, out.to_csv(index=False).encode())
     
-    print(f"Backfill complete. {len(rows)} days written (Yesterday and older).")
+    print(f"Backfill complete. {len(out)} days written.")
+    return 0
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
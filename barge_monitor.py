@@ -6,90 +6,272 @@ Fixes: Corrects unit label to 'barges' (count) to match GTR Figure 10 data.
 
 from __future__ import annotations
 import io
-import json
 import os
 import re
-from datetime import datetime, timezone
-import pandas as pd
+from datetime import date
+from typing import TYPE_CHECKING, Optional, Tuple
 import requests
+from pipeline_common import append_bytes, epoch_days, fetch_if_modified, load_json, refresh_generated_at, rolling_delta, utc_now_iso, write_if_changed, write_json
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # openpyxl's streaming reader is the slower fallback
+    CalamineWorkbook = None
+
+# pandas/numpy are imported inside the functions that need them, so a run where
+# the workbook is unchanged never pays their import cost
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
 
 LOCKS27_XLSX_URL = "https://www.ams.usda.gov/sites/default/files/media/GTRFigure10.xlsx"
 OUT_HIST = "data/history/barge_locks27_weekly.csv"
 OUT_STATUS = "data/barge_status.json"
 
-def utc_now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+# Explicit dtypes spare read_csv its per-column inference; total_tons is the legacy name
+HIST_DTYPES = {
+    "week_end_date": "str",
+    "total_barges": "float64",
+    "total_tons": "float64",
+    "source_url": "str",
+    "ingested_at_utc": "str",
+}
+
+SESSION = requests.Session()
+
+_WS_RE = re.compile(r"\s+")
+_HEADER_RE = re.compile(r"date|week")
 
-def fetch_locks27() -> pd.DataFrame:
+def norm_header(x: object) -> str:
+    # Numeric/date cells can never be a header label, skip the string work
+    if not isinstance(x, str):
+        return ""
+    return _WS_RE.sub(" ", x.strip().lower())
+
+def download(url: str, ingested_sha256: Optional[str]) -> Tuple[Optional[io.BytesIO], str]:
+    """
+    Conditional GET through the shared HTTP cache: the workbook and its
+    SHA-256, the workbook None when it is the one ingested last.
+    """
+    body, digest = fetch_if_modified(SESSION, url, ingested_sha256, timeout=60)
+    return (None if body is None else io.BytesIO(body)), digest
+
+def _load_locks_rows(buf: io.BytesIO) -> list:
+    """First sheet as plain row lists; no styles and no intermediate DataFrame."""
+    if CalamineWorkbook is not None:
+        return CalamineWorkbook.from_filelike(buf).get_sheet_by_index(0).to_python()
+    from openpyxl import load_workbook
+    wb = load_workbook(buf, read_only=True, data_only=True)
     try:
-        b = requests.get(LOCKS27_XLSX_URL, timeout=60).content
-        # Header hunting logic
-        raw = pd.read_excel(io.BytesIO(b), engine="openpyxl", header=None)
-        header_idx = 0
-        for i, row in raw.head(20).iterrows():
-            row_str = " ".join([str(x).lower() for x in row.values])
-            if "date" in row_str or "week" in row_str:
-                header_idx = i
-                break
-        
-        df = pd.read_excel(io.BytesIO(b), engine="openpyxl", header=header_idx)
-        df.columns = [str(c).strip().lower() for c in df.columns]
-        
-        # Find date column
-        date_col = next((c for c in df.columns if "date" in c or "week" in c), None)
-        # Find total column (It is usually 'Total' representing count of barges)
-        total_col = next((c for c in df.columns if "total" in c), None)
-        
-        if not date_col or not total_col:
-            raise ValueError("Columns not found")
+        return [list(r) for r in wb.worksheets[0].iter_rows(values_only=True)]
+    finally:
+        wb.close()
 
-        out = df[[date_col, total_col]].copy()
-        out.columns = ["week_end_date", "total_barges"]
-        
-        out["week_end_date"] = pd.to_datetime(out["week_end_date"], errors="coerce").dt.strftime("%Y-%m-%d")
-        out["total_barges"] = pd.to_numeric(out["total_barges"], errors="coerce")
-        out = out.dropna()
-        
-        return out.sort_values("week_end_date")
-    except Exception as e:
-        print(f"Barge fetch failed: {e}")
-        return pd.DataFrame()
+def find_header_row(rows: list, limit: int = 20) -> int:
+    """First row in the top `limit` with a date/week label; stops at the first hit."""
+    for i, row in enumerate(rows[:limit]):
+        if any(_HEADER_RE.search(norm_header(x)) for x in row if isinstance(x, str)):
+            return i
+    return 0
 
-def main() -> int:
-    new_data = fetch_locks27()
+def detect_date_column(body: list, sample: int = 40, min_share: float = 0.9) -> Optional[int]:
+    """
+    Fallback when no header mentions a date: the first column whose sampled cells
+    are mostly Excel dates. Only `sample` rows are inspected, and the scan stops
+    at the first column that qualifies.
+    """
+    head = body[:sample]
+    width = max((len(r) for r in head), default=0)
+    for i in range(width):
+        cells = [r[i] for r in head if i < len(r) and r[i] not in ("", None)]
+        if cells and sum(isinstance(x, date) for x in cells) >= min_share * len(cells):
+            return i
+    return None
+
+def fetch_locks27(ingested_sha256: Optional[str]) -> Tuple[Optional[pd.DataFrame], str]:
+    """
+    Parsed Locks 27 weeks and the workbook's SHA-256. The weeks are None when
+    the digest equals ingested_sha256, i.e. the workbook was already ingested.
+    A failed download or parse raises.
+    """
+    buf, digest = download(LOCKS27_XLSX_URL, ingested_sha256)
+    if buf is None:
+        return None, digest
+    import pandas as pd
+
+    rows = _load_locks_rows(buf)
+    header_idx = find_header_row(rows)
     
-    # Load and Update History
-    if os.path.exists(OUT_HIST):
-        hist = pd.read_csv(OUT_HIST)
-        combined = pd.concat([hist, new_data]).drop_duplicates(subset=["week_end_date"], keep="last")
-    else:
-        combined = new_data
+    header = [norm_header(c) for c in rows[header_idx]]
+    
+    # Find date and total columns in one pass over the header names.
+    # Total is usually 'Total' representing count of barges; the date column
+    # is never a candidate for it.
+    date_i = total_i = None
+    for i, c in enumerate(header):
+        if date_i is None and ("date" in c or "week" in c):
+            date_i = i
+        elif total_i is None and "total" in c:
+            total_i = i
+        if date_i is not None and total_i is not None:
+            break
+    
+    body = rows[header_idx + 1:]
+    if date_i is None:
+        date_i = detect_date_column(body)
+    if date_i is None or total_i is None or date_i == total_i:
+        raise ValueError("Columns not found")
+
+    out = pd.DataFrame({
+        "week_end_date": [r[date_i] for r in body],
+        "total_barges": [r[total_i] for r in body],
+    })
+    
+    out["week_end_date"] = pd.to_datetime(out["week_end_date"], errors="coerce").dt.strftime("%Y-%m-%d")
+    # float64 as in HIST_DTYPES, so a first write and later rewrites format alike
+    out["total_barges"] = pd.to_numeric(out["total_barges"], errors="coerce").astype("float64")
+    out = out.dropna()
     
-    combined = combined.sort_values("week_end_date")
-    os.makedirs(os.path.dirname(OUT_HIST), exist_ok=True)
-    combined.to_csv(OUT_HIST, index=False)
+    return out.sort_values("week_end_date"), digest
+
+def _appendable_rows(
+    hist: pd.DataFrame, new_df: pd.DataFrame, hist_days: np.ndarray, new_days: np.ndarray
+) -> Optional[pd.DataFrame]:
+    """
+    Rows of new_df, laid out like the history file, that can simply be appended
+    to it; None when the file has to be rewritten (a column the file lacks,
+    revised or back-filled values, out-of-order weeks).
+    new_df only carries week_end_date and total_barges, so stored weeks are
+    compared on those columns; provenance and the legacy total_tons are left
+    blank on new rows, as the combine_first rewrite leaves them.
+    """
+    import numpy as np
+
+    if not set(new_df.columns) <= set(hist.columns):
+        return None
+    known = np.isin(new_days, hist_days)
+    if not known.all() and new_days[~known].min() <= hist_days.max():
+        return None
+    stored = hist.set_index(hist_days).reindex(new_days[known])[new_df.columns]
+    seen = new_df[known].set_index(new_days[known])
+    same = (stored == seen) | (stored.isna() & seen.isna())
+    if not same.all().all():
+        return None
+    fresh = new_df[~known].iloc[np.argsort(new_days[~known], kind="stable")]
+    return fresh.reindex(columns=hist.columns).astype(hist.dtypes.to_dict())
+
+def update_history(new_df: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Upsert new weeks into the history CSV keyed on week_end_date.
+    New values win; columns the new frame lacks keep their stored values.
+    When nothing stored changes, only the new weeks are appended to the file.
+    Weeks are matched and ordered by epoch_days, not by their strings.
+    """
+    import numpy as np
+    import pandas as pd
+
+    hist = pd.read_csv(OUT_HIST, dtype=HIST_DTYPES) if os.path.exists(OUT_HIST) else pd.DataFrame()
+    if new_df is None or new_df.empty:
+        return hist
+
+    if hist.empty:
+        combined = new_df
+    else:
+        hist_days = epoch_days(hist["week_end_date"])
+        new_days = epoch_days(new_df["week_end_date"])
+        fresh = _appendable_rows(hist, new_df, hist_days, new_days)
+        if fresh is not None:
+            if not fresh.empty:
+                append_bytes(OUT_HIST, fresh.to_csv(header=False, index=False).encode())
+            return pd.concat([hist, fresh], ignore_index=True)
+
+        combined = (
+            new_df.set_index(new_days)
+            .combine_first(hist.set_index(hist_days))
+            .sort_index()
+            .reset_index(drop=True)
+        )
+        combined = combined[["week_end_date"] + [c for c in combined.columns if c != "week_end_date"]]
+
+    write_if_changed(OUT_HIST, combined.to_csv(index=False).encode())
+    return combined
+
+def barge_counts(combined: pd.DataFrame) -> pd.DataFrame:
+    """
+    Numeric, week-sorted counts with unparseable rows dropped.
+    Computed once so the status fields don't each re-coerce the history.
+    """
+    import pandas as pd
+
+    if combined.empty:
+        return pd.DataFrame(columns=["week_end_date", "total_barges"])
+
+    total = pd.Series(float("nan"), index=combined.index)
+    # Older history rows stored the same barge count under total_tons
+    for col in ("total_barges", "total_tons"):
+        if col in combined.columns:
+            total = total.fillna(pd.to_numeric(combined[col], errors="coerce"))
+
+    counts = pd.DataFrame({"week_end_date": combined["week_end_date"], "total_barges": total})
+    return counts.dropna().sort_values("week_end_date").reset_index(drop=True)
+
+def drop_latest_zero_if_placeholder(counts: pd.DataFrame) -> Tuple[pd.DataFrame, Optional[str]]:
+    """
+    GTR lists the newest week as 0 until the count is in. Drop a trailing zero when
+    the weeks before it were active. Only the last 9 values are inspected.
+    Returns the (possibly trimmed) counts and the dropped week, if any.
+    """
+    import numpy as np
+
+    tail = counts["total_barges"].to_numpy()[-9:]
+    if len(tail) < 2 or tail[-1] != 0.0:
+        return counts, None
+    prev = tail[:-1]
+    if prev[-1] > 0 and (prev > 0).sum() >= len(prev) - 1 and np.median(prev) > 0:
+        return counts.iloc[:-1], str(counts["week_end_date"].iat[-1])
+    return counts, None
+
+def main() -> int:
+    # Only the digest recorded after a successful ingest may skip the run: the
+    # HTTP cache also holds workbooks whose parse failed
+    ingested = load_json(OUT_STATUS).get("source_sha256")
+    try:
+        new_data, digest = fetch_locks27(ingested)
+    except Exception as e:
+        print(f"Barge fetch failed: {e}")
+        # Status is rebuilt from the stored history; the digest stays that of
+        # the last successful ingest, so the next run retries this workbook
+        new_data, digest, rc = None, ingested, 1
+    else:
+        if new_data is None and refresh_generated_at(OUT_STATUS):
+            print("Locks 27 workbook already ingested; status timestamp refreshed")
+            return 0
+        rc = 0
+    combined = update_history(new_data)
+    counts, dropped_week = drop_latest_zero_if_placeholder(barge_counts(combined))
     
     # Status JSON
-    latest = combined.iloc[-1] if not combined.empty else None
-    delta = 0
-    if len(combined) >= 5:
-        delta = float(combined.iloc[-1]["total_barges"] - combined.iloc[-5]["total_barges"])
+    weeks = counts["week_end_date"]
+    totals = counts["total_barges"]
+    has_latest = not counts.empty
+    delta = float(rolling_delta(totals, 4)[-1]) if len(counts) >= 5 else 0
 
     status = {
         "generated_at_utc": utc_now_iso(),
+        "source_sha256": digest,
         "locks_27": {
-            "week_end_date": str(latest["week_end_date"]) if latest is not None else None,
-            "value": float(latest["total_barges"]) if latest is not None else None,
+            "week_end_date": str(weeks.iat[-1]) if has_latest else None,
+            "value": float(totals.iat[-1]) if has_latest else None,
             "delta_4w": delta,
             "unit": "barges" # Correct unit
         }
     }
+    if dropped_week:
+        status["locks_27"]["note"] = f"dropped trailing zero placeholder at {dropped_week}"
     
-    with open(OUT_STATUS, "w") as f:
-        json.dump(status, f, indent=2)
+    write_json(OUT_STATUS, status)
         
     print(f"Barge data updated. Latest: {status['locks_27']['value']}")
-    return 0
+    return rc
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -4,109 +4,158 @@ generate_risk.py - FIXED
 Smart deduplication: Overwrites 'Today' if already exists to ensure live convergence.
 """
 from __future__ import annotations
-import csv
-import json
+import io
 import os
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from pipeline_common import EMPTY, load_json, utc_now_iso, write_json
+from risk_core import composite, score_barge, score_rail, score_river
 
 OUT_RISK = "data/composite_risk_score.json"
 OUT_RISK_HIST = "data/history/risk_daily.csv"
+HIST_HEADER = "timestamp_utc,risk_score,risk_level,primary_driver\n"
 
-def utc_now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+# The only status fields scoring reads, per file: name -> path of keys to a scalar
+SCORE_INPUTS = {
+    "data/river_status.json": {
+        "river_delta_7d": ("sites", "st_louis_mo", "gage_height_ft", "delta_7d"),
+        "river_stage": ("sites", "st_louis_mo", "gage_height_ft", "latest_value"),
+    },
+    "data/rail_status.json": {
+        "rail_dwell_4w": ("carriers", "UP", "metrics", "terminal_dwell_hours", "delta_4w"),
+    },
+    "data/barge_status.json": {
+        "barge_delta_4w": ("locks_27", "delta_4w"),
+    },
+}
 
-def load_json(path):
-    if not os.path.exists(path): return {}
-    with open(path, "r") as f: return json.load(f)
+def dig(d, *path):
+    """Walk nested status dicts; a missing/null key or non-dict level yields EMPTY."""
+    try:
+        for key in path:
+            d = d.get(key) or EMPTY
+    except AttributeError:
+        return EMPTY
+    return d
 
-def update_risk_history(score, level, driver):
+def extract(path, fields):
     """
-    Reads history, removes any existing row for 'Today', appends new row.
+    Just the named scalars from one status file (None where missing).
+    The parsed tree, river's 7-day series included, is dropped on return.
+    """
+    doc = load_json(path)
+    return {name: dig(doc, *keys[:-1]).get(keys[-1]) for name, keys in fields.items()}
+
+def _today_rows_offset(f, today, block):
+    """
+    Byte offset where the trailing run of today's rows starts (the file size if
+    there are none), found from the last `block` bytes only. None when the tail
+    can't decide it: missing header, no final newline, rows dated after today,
+    or today's rows reaching past the window.
+    """
+    f.seek(0)
+    if f.read(13) != b"timestamp_utc":
+        return None
+    size = f.seek(0, os.SEEK_END)
+    start = max(0, size - block)
+    f.seek(start)
+    buf = f.read()
+    if not buf.endswith(b"\n"):
+        return None
+    lines = buf.splitlines(keepends=True)
+    pos = size
+    # A window that starts mid-file begins with a partial line; never trust it
+    for line in reversed(lines[1:] if start else lines):
+        if not line.startswith(today):
+            # A row dated after today means the file isn't in order; rewrite it
+            return pos if line[:10] < today or line.startswith(b"timestamp_utc") else None
+        pos -= len(line)
+    return None
+
+def update_risk_history(score, level, driver, now):
+    """
+    Removes any existing row for 'Today' and appends the new row.
     Ensures the chart always ends with the latest live value.
+    Rows are chronological, so today's can only be at the end: the file is
+    truncated there and appended to. The full read/filter/rewrite only runs
+    when the tail alone can't settle it.
     """
-    os.makedirs(os.path.dirname(OUT_RISK_HIST), exist_ok=True)
-    today_str = utc_now_iso()[:10]
-    
-    lines = []
-    if os.path.exists(OUT_RISK_HIST):
-        with open(OUT_RISK_HIST, "r") as f:
-            lines = f.readlines()
-    
-    # Filter out any line that starts with today's date
-    # This acts as an "Upsert" (Update or Insert)
-    clean_lines = [line for line in lines if not line.startswith(today_str)]
-    
-    # If file was empty or only header
-    if not clean_lines:
-        clean_lines = ["timestamp_utc,risk_score,risk_level,primary_driver\n"]
-    elif not clean_lines[0].startswith("timestamp_utc"):
-        clean_lines.insert(0, "timestamp_utc,risk_score,risk_level,primary_driver\n")
-
-    # Append new line
-    new_line = f"{utc_now_iso()},{score},{level},{driver}\n"
-    clean_lines.append(new_line)
-    
-    with open(OUT_RISK_HIST, "w", encoding="utf-8") as f:
-        f.writelines(clean_lines)
+    today_str = now[:10]
+    new_line = f"{now},{score},{level},{driver}\n"
+
+    # Open first and handle the missing file, rather than stat-ing ahead of every run
+    try:
+        f = open(OUT_RISK_HIST, "r+b")
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(OUT_RISK_HIST), exist_ok=True)
+        with open(OUT_RISK_HIST, "w", encoding="utf-8") as f:
+            f.write(HIST_HEADER + new_line)
+        return
+
+    # One handle for the whole upsert, whichever path it takes
+    with f:
+        # Upserts keep at most one row per day at the end, so 256 bytes
+        # nearly always decide it; widen once before falling back
+        cut = _today_rows_offset(f, today_str.encode(), 256)
+        if cut is None:
+            cut = _today_rows_offset(f, today_str.encode(), 4096)
+        if cut is not None:
+            f.seek(cut)
+            f.truncate()
+            f.write(new_line.encode())
+            return
+
+        f.seek(0)
+        lines = io.StringIO(f.read().decode("utf-8"), newline=None).readlines()
+
+        # Filter out any line that starts with today's date
+        # This acts as an "Upsert" (Update or Insert)
+        clean_lines = [line for line in lines if not line.startswith(today_str)]
+
+        # If file was empty or only header
+        if not clean_lines or not clean_lines[0].startswith("timestamp_utc"):
+            clean_lines.insert(0, HIST_HEADER)
+
+        # Append new line
+        clean_lines.append(new_line)
+
+        f.seek(0)
+        f.write("".join(clean_lines).encode())
+        f.truncate()
 
 def main():
-    river = load_json("data/river_status.json")
-    rail = load_json("data/rail_status.json")
-    barge = load_json("data/barge_status.json")
+    # One timestamp per run so the snapshot and its history row always agree
+    now = utc_now_iso()
+    # Independent reads; overlap their I/O instead of waiting on each in turn
+    inputs = {}
+    with ThreadPoolExecutor(max_workers=len(SCORE_INPUTS)) as ex:
+        for found in ex.map(extract, SCORE_INPUTS, SCORE_INPUTS.values()):
+            inputs.update(found)
 
-    drivers = []
-    
     # 1. RIVER
-    r_score = 0
-    stl = river.get("sites", {}).get("st_louis_mo", {}).get("gage_height_ft", {})
-    delta = float(stl.get("delta_7d") or 0)
-    val = stl.get("latest_value")
-    
-    if delta < -2.0: r_score += 20
-    if val is not None and float(val) < 0.0: r_score += 20
-    if r_score > 0: drivers.append({"name": "river", "score": r_score})
+    val = inputs["river_stage"]
+    r_score = score_river(float(inputs["river_delta_7d"] or 0), None if val is None else float(val))
 
     # 2. RAIL
-    rr_score = 0
-    up = rail.get("carriers", {}).get("UP", {}).get("metrics", {}).get("terminal_dwell_hours", {})
-    up_delta = float(up.get("delta_4w") or 0)
-    
-    if up_delta > 2.0: rr_score += 30
-    elif up_delta > 0.5: rr_score += 15
-    if rr_score > 0: drivers.append({"name": "rail", "score": rr_score})
+    rr_score = score_rail(float(inputs["rail_dwell_4w"] or 0))
 
     # 3. BARGE
-    b_score = 0
-    l27 = barge.get("locks_27", {})
-    l27_delta = float(l27.get("delta_4w") or 0)
-    
-    # Count Thresholds
-    if l27_delta < -50: b_score += 30
-    elif l27_delta < -20: b_score += 15
-    if b_score > 0: drivers.append({"name": "barge", "score": b_score})
+    b_score = score_barge(float(inputs["barge_delta_4w"] or 0))
 
     # Composite
-    total = min(100, r_score + rr_score + b_score)
-    level = "LOW"
-    if total > 70: level = "CRITICAL"
-    elif total > 40: level = "MODERATE"
-
-    primary = "none"
-    if drivers:
-        primary = max(drivers, key=lambda x: x["score"])["name"]
+    total, level, primary, drivers = composite((r_score, rr_score, b_score))
 
     out = {
-        "generated_at_utc": utc_now_iso(),
+        "generated_at_utc": now,
         "risk_score": total,
         "risk_level": level,
         "primary_driver": primary,
         "drivers": drivers
     }
 
-    with open(OUT_RISK, "w") as f:
-        json.dump(out, f, indent=2)
+    # Only the dashboard reads this one, so it skips the indentation
+    write_json(OUT_RISK, out, indent=False)
     
-    update_risk_history(total, level, primary)
+    update_risk_history(total, level, primary, now)
     print(f"Risk Score: {total} ({level})")
 
 if __name__ == "__main__":
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+pipeline_common.py
+
+Helpers shared by the monitor and risk scripts.
+HTTP responses are cached under data/.cache so reruns can revalidate
+with ETag / Last-Modified instead of downloading the full body again.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, Mapping, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # stdlib json is the slower fallback
+    orjson = None
+
+ujson = None
+if orjson is None:
+    try:  # still parses well ahead of stdlib json; dumps stay on stdlib for the layout
+        import ujson
+    except ImportError:
+        pass
+
+if TYPE_CHECKING:  # only needed for annotations; keeps generate_risk import-light
+    import numpy
+    import requests
+
+CACHE_DIR = "data/.cache"
+# Live entries are refreshed on every run; anything older belongs to a URL or
+# query no longer requested (e.g. last month's STB workbook) and is pruned
+CACHE_MAX_AGE = 14 * 86400
+
+# Shared read-only default for nested .get() lookups; never allocates on a miss
+EMPTY: Mapping = MappingProxyType({})
+
+
+def utc_now_iso() -> str:
+    # Formatted straight to the Z suffix; always carries microseconds
+    return f"{datetime.now(timezone.utc):%Y-%m-%dT%H:%M:%S.%fZ}"
+
+
+def epoch_days(dates: object) -> "numpy.ndarray":
+    """
+    YYYY-MM-DD strings as int32 days since 1970-01-01.
+    History upserts key and sort on these instead of comparing strings.
+    """
+    import numpy as np  # local so generate_risk never pays for numpy
+
+    return np.asarray(dates, dtype="datetime64[D]").astype(np.int32)
+
+
+def rolling_delta(values: object, k: int) -> "numpy.ndarray":
+    """
+    values[i] - values[i - k] for every position, 0.0 where there is no value k back.
+    One vectorized subtraction, so a whole history is as cheap as its last point.
+    """
+    import numpy as np
+
+    v = np.asarray(values, dtype=np.float64)
+    out = np.zeros_like(v)
+    if k < v.size:
+        out[k:] = v[k:] - v[:-k]
+    return out
+
+
+def make_session(pool: int = 4, retries: int = 3, backoff: float = 0.3) -> requests.Session:
+    """
+    A requests Session that keeps up to `pool` connections per host alive for
+    concurrent fetches, and retries connection errors and 429/5xx answers with
+    exponential backoff. After the last retry the response is returned as is,
+    so raise_for_status still reports it.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def read_body(r: requests.Response) -> bytes:
+    """
+    The whole body of a stream=True response in one urllib3 read, with the
+    gzip/deflate transfer encoding the session negotiates already undone.
+    Spares requests' 10 KB iter_content chunks and the join that copies them.
+    """
+    return r.raw.read(decode_content=True)
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """
+    Write to a temp file beside path, then os.replace it in, so readers only
+    ever see the old or the new file. The temp name carries the pid, so two
+    overlapping runs never write into each other's temp file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def loads_json(data: bytes) -> object:
+    """Parse JSON bytes with orjson, else ujson, else stdlib json; all take bytes directly."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def load_json(path: str) -> dict:
+    """A JSON file as a dict, or {} when it does not exist yet."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    return loads_json(data)
+
+
+def _json_default(o: object) -> object:
+    # numpy scalars/arrays on the stdlib path (orjson serializes them natively)
+    if hasattr(o, "tolist"):
+        return o.tolist()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def dumps_json(obj: object, indent: bool = True) -> bytes:
+    """
+    JSON bytes, 2-space indented or compact; orjson when installed, same
+    layout either way.
+    """
+    if orjson is not None:
+        opts = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=opts, default=_json_default)
+    if indent:
+        return json.dumps(obj, indent=2, default=_json_default).encode()
+    return json.dumps(obj, separators=(",", ":"), default=_json_default).encode()
+
+
+def write_json(path: str, obj: object, indent: bool = True) -> None:
+    """JSON written atomically, so the dashboard never reads a partial file."""
+    write_if_changed(path, dumps_json(obj, indent))
+
+
+def refresh_generated_at(path: str, now: Optional[str] = None) -> bool:
+    """
+    When a source is unchanged, everything derived from it is too; only the
+    status file's generated_at_utc moves. Returns False when there is no status
+    file to refresh.
+    """
+    status = load_json(path)
+    if not status:
+        return False
+    status["generated_at_utc"] = now or utc_now_iso()
+    write_json(path, status)
+    return True
+
+
+def append_bytes(path: str, data: bytes) -> None:
+    """
+    Append pre-serialized rows in one write() on an O_APPEND descriptor.
+    pandas' to_csv(mode="a") flushes in chunks, so an interrupted run could
+    leave a torn row at the end of a history file.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def write_if_changed(path: str, data: bytes) -> bool:
+    """
+    write_atomic unless the file already holds exactly these bytes.
+    A size mismatch from os.stat settles it without reading the old file.
+    Returns True when the file was written.
+    """
+    try:
+        if os.stat(path).st_size == len(data):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+    write_atomic(path, data)
+    return True
+
+
+def _cache_paths(url: str, params: Optional[Dict[str, str]]) -> Tuple[str, str]:
+    key = json.dumps([url, sorted((params or {}).items())])
+    base = os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest()[:16])
+    return base + ".body", base + ".meta.json"
+
+
+def _revalidate(
+    session: requests.Session,
+    url: str,
+    params: Optional[Dict[str, str]],
+    ttl: Optional[float],
+    timeout: float,
+) -> Tuple[Optional[bytes], bool, Optional[str]]:
+    """
+    The request half of cached_get. Returns (None, False, sha256) when the
+    cached body is still current, without reading it; otherwise the fetched
+    body, whether it differs from the cached one, and its SHA-256.
+    """
+    body_path, meta_path = _cache_paths(url, params)
+
+    meta: Dict[str, object] = {}
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if ttl is not None and time.time() - float(meta.get("fetched_at", 0)) < ttl:
+            return None, False, meta.get("sha256")
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = str(meta["etag"])
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = str(meta["last_modified"])
+
+    with session.get(url, params=params, headers=headers, timeout=timeout, stream=True) as r:
+        if r.status_code == 304 and meta:
+            meta["fetched_at"] = time.time()
+            write_atomic(meta_path, json.dumps(meta).encode())
+            return None, False, meta.get("sha256")
+        r.raise_for_status()
+        body = read_body(r)
+
+    digest = hashlib.sha256(body).hexdigest()
+    modified = digest != meta.get("sha256")
+    if modified:
+        write_atomic(body_path, body)
+    write_atomic(meta_path, json.dumps({
+        "url": url,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "sha256": digest,
+        "fetched_at": time.time(),
+    }).encode())
+    return body, modified, digest
+
+
+def prune_cache(max_age: float = CACHE_MAX_AGE) -> int:
+    """
+    Delete cache entries whose fetched_at is more than max_age seconds old,
+    plus bodies left without their meta file. Returns the number of files removed.
+    """
+    try:
+        names = os.listdir(CACHE_DIR)
+    except FileNotFoundError:
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        if name.endswith(".meta.json"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    fetched_at = float(json.load(f).get("fetched_at", 0))
+            except (OSError, ValueError, AttributeError):
+                fetched_at = 0.0
+            if fetched_at >= cutoff:
+                continue
+            stale = (path, path[: -len(".meta.json")] + ".body")
+        elif name.endswith(".body") and not os.path.exists(path[: -len(".body")] + ".meta.json"):
+            stale = (path,)
+        else:
+            continue
+        for p in stale:
+            try:
+                os.remove(p)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def cached_body(url: str, params: Optional[Dict[str, str]] = None) -> bytes:
+    """The body cached for url, as last stored by cached_get."""
+    with open(_cache_paths(url, params)[0], "rb") as f:
+        return f.read()
+
+
+def cached_get(
+    session: requests.Session,
+    url: str,
+    params: Optional[Dict[str, str]] = None,
+    ttl: Optional[float] = None,
+    timeout: float = 60,
+    stale_if_error: bool = False,
+) -> Tuple[bytes, bool]:
+    """
+    GET url through the on-disk cache.
+    A cached body younger than ttl seconds is returned without a request.
+    Otherwise the stored validators are sent and a 304 reuses the cached body.
+    A full 200 whose SHA-256 matches the cached body also counts as unmodified,
+    which covers servers that ignore the validators.
+    With stale_if_error, a failed request (connection error, timeout or error
+    status) falls back to the cached body when there is one.
+    Returns (body, modified) where modified is False when the content is unchanged.
+    """
+    try:
+        body, modified, _ = _revalidate(session, url, params, ttl, timeout)
+    except OSError:  # requests.RequestException derives from it
+        if not (stale_if_error and os.path.exists(_cache_paths(url, params)[0])):
+            raise
+        return cached_body(url, params), False
+    if body is None:
+        body = cached_body(url, params)
+    return body, modified
+
+
+def fetch_if_modified(
+    session: requests.Session,
+    url: str,
+    ingested_sha256: Optional[str],
+    params: Optional[Dict[str, str]] = None,
+    timeout: float = 60,
+) -> Tuple[Optional[bytes], str]:
+    """
+    cached_get for callers that skip their work on content they have already
+    ingested. Returns (body, sha256), with body None when the digest equals
+    ingested_sha256, the one the caller recorded after its last successful
+    ingest; the cached body is then never read back from disk.
+    Whether the HTTP cache saw a change can't decide this: it stores a body as
+    soon as it is downloaded, before the caller has parsed it, so a run that
+    failed would otherwise be skipped from then on.
+    """
+    body, _, digest = _revalidate(session, url, params, None, timeout)
+    if digest is not None and digest == ingested_sha256:
+        return None, digest
+    if body is None:
+        body = cached_body(url, params)
+    if digest is None:  # cache entry from before digests were stored
+        digest = hashlib.sha256(body).hexdigest()
+    return body, digest
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+risk_core.py
+
+Composite risk scoring shared by generate_risk.py (today's snapshot) and
+backfill_risk.py (daily history). Pure stdlib at import, so generate_risk
+stays import-light; tiered_array imports numpy only when backfill_risk calls it.
+"""
+
+from __future__ import annotations
+
+from operator import itemgetter
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import numpy
+
+# Each rule is an ordered tuple of (threshold, points) tiers; the first crossed tier scores
+SCORE_CONFIG = {
+    "river_drop_7d": ((-2.0, 20),),            # stage fell more than 2 ft in 7 days
+    "river_low_stage": ((0.0, 20),),           # stage below 0 ft
+    "rail_dwell_4w": ((2.0, 30), (0.5, 15)),   # UP terminal dwell rising
+    "barge_drop_4w": ((-50, 30), (-20, 15)),   # Locks 27 count falling
+    "level_cuts": (40, 70),                    # > MODERATE, > CRITICAL
+    "cap": 100,
+}
+
+LEVELS = ("LOW", "MODERATE", "CRITICAL")
+DRIVERS = ("river", "rail", "barge")
+
+_score = itemgetter(1)
+
+
+def tiered(x: float, tiers: Sequence[Tuple[float, int]], above: bool) -> int:
+    """Points of the first tier whose threshold x crosses (> when above, else <), or 0."""
+    return next((pts for cut, pts in tiers if (x > cut if above else x < cut)), 0)
+
+
+def tiered_array(x: "numpy.ndarray", tiers: Sequence[Tuple[float, int]], above: bool) -> "numpy.ndarray":
+    """tiered applied elementwise: int16 points for every value of x (NaN scores 0)."""
+    import numpy as np
+
+    out = np.zeros(np.shape(x), dtype=np.int16)
+    # Lowest-priority tier first, so earlier tiers overwrite it where they match
+    for cut, pts in reversed(tiers):
+        out = np.where(x > cut if above else x < cut, pts, out)
+    return out
+
+
+def score_river(delta_7d: float, latest_stage: Optional[float], cfg: Dict = SCORE_CONFIG) -> int:
+    score = tiered(delta_7d, cfg["river_drop_7d"], above=False)
+    if latest_stage is not None:
+        score += tiered(latest_stage, cfg["river_low_stage"], above=False)
+    return score
+
+
+def score_rail(dwell_delta_4w: float, cfg: Dict = SCORE_CONFIG) -> int:
+    return tiered(dwell_delta_4w, cfg["rail_dwell_4w"], above=True)
+
+
+def score_barge(delta_4w: float, cfg: Dict = SCORE_CONFIG) -> int:
+    return tiered(delta_4w, cfg["barge_drop_4w"], above=False)
+
+
+def composite(scores: Sequence[int], cfg: Dict = SCORE_CONFIG) -> Tuple[int, str, str, List[Dict[str, object]]]:
+    """
+    Combine per-driver scores (ordered as DRIVERS) into
+    (total, level, primary_driver, drivers). Ties go to the earlier driver.
+    """
+    scored = [(name, s) for name, s in zip(DRIVERS, scores) if s > 0]
+    total = min(cfg["cap"], sum(scores))
+    moderate, critical = cfg["level_cuts"]
+    level = LEVELS[(total > moderate) + (total > critical)]
+    # max keeps the first of equal scores, so ties still go to the earlier driver
+    primary = max(scored, key=_score)[0] if scored else "none"
+    drivers = [{"name": name, "score": s} for name, s in scored]
+    return total, level, primary, drivers
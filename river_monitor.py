@@ -10,15 +10,19 @@ Fixes:
 
 from __future__ import annotations
 
-import json
-import os
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 from typing import Dict, List, Optional, Tuple, Any
 
-import requests
+from pipeline_common import EMPTY, cached_get, loads_json, make_session, utc_now_iso, write_json
 
 USGS_IV_JSON = "https://waterservices.usgs.gov/nwis/iv/"
 TIMEOUT = 45
+# USGS publishes IV readings every 15-60 min; a rerun within this many seconds
+# reuses the payload cached under data/.cache instead of pulling 7 days again
+CACHE_TTL = 900
+# Window requested, relative to now (7 days 6 hours). A fixed period keeps the
+# cache key stable across runs, unlike an absolute startDT
+IV_PERIOD = "PT174H"
 
 SITES = {
     "st_louis_mo": {"site_no": "07010000", "label": "Mississippi River at St Louis MO"},
@@ -27,78 +31,156 @@ SITES = {
 
 PARAM_GAGE_HEIGHT = "00065"
 PARAM_DISCHARGE = "00060"
+# Parameter code -> position in build_site's (stage, discharge) series
+SERIES_SLOTS = {PARAM_GAGE_HEIGHT: 0, PARAM_DISCHARGE: 1}
 OUT_STATUS = "data/river_status.json"
 
-def utc_now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+# The dashboard charts every 16th reading (4-8 h apart at 15/30-min cadence);
+# only those are written, the stats still use the full series
+SERIES_STEP = 16
 
-def fetch_usgs_iv(site_no: str, start_dt_utc: datetime, parameter_cd: Optional[str]) -> dict:
+# Retrying session; all sites come back in one request
+SESSION = make_session(pool=1)
+
+def fetch_usgs_iv(site_nos: str, parameter_cd: Optional[str]) -> dict:
+    """IV data for a comma-separated list of sites, {} when the request fails."""
     params = {
         "format": "json",
-        "sites": site_no,
+        "sites": site_nos,
         "siteStatus": "all",
-        "startDT": start_dt_utc.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "period": IV_PERIOD,
     }
     if parameter_cd:
         params["parameterCd"] = parameter_cd
     
     try:
-        r = requests.get(USGS_IV_JSON, params=params, timeout=TIMEOUT)
-        r.raise_for_status()
-        return r.json()
+        # A failed refresh falls back to the last payload cached for these sites
+        body, _ = cached_get(SESSION, USGS_IV_JSON, params, ttl=CACHE_TTL, timeout=TIMEOUT, stale_if_error=True)
+        return loads_json(body)
     except Exception as e:
-        print(f"USGS fetch failed for {site_no}: {e}")
+        print(f"USGS fetch failed for {site_nos}: {e}")
         return {}
 
-def extract_points(ts: dict) -> List[Tuple[str, float]]:
-    values = ts.get("values", []) or []
+def series_by_site(data: dict) -> Dict[str, List[dict]]:
+    """The timeSeries blocks of a multi-site response, grouped by site number."""
+    by_site: Dict[str, List[dict]] = {}
+    for ts in data.get("value", EMPTY).get("timeSeries") or ():
+        codes = ts.get("sourceInfo", EMPTY).get("siteCode") or (EMPTY,)
+        by_site.setdefault(codes[0].get("value"), []).append(ts)
+    return by_site
+
+# A series as parallel columns (timestamps, values), the layout the JSON uses
+Series = Tuple[List[str], List[float]]
+
+def extract_points(ts: dict) -> Series:
+    values = ts.get("values") or ()
     if not values:
-        return []
-    arr = values[0].get("value", []) or []
-    pts: List[Tuple[str, float]] = []
-    for v in arr:
-        t = v.get("dateTime")
-        x = v.get("value")
-        if t is None or x is None:
-            continue
+        return [], []
+    arr = values[0].get("value") or ()
+    # Fast path: USGS rows are normally complete, string-timed and numeric, so
+    # both columns come out of two comprehensions; any gap or odd cell falls
+    # back to the per-row filter below
+    try:
+        t_utc = [p["dateTime"] for p in arr]
+        v = [float(p["value"]) for p in arr]
+        if set(map(type, t_utc)) == {str}:
+            return t_utc, v
+    except Exception:
+        pass
+    t_utc = []
+    v = []
+    # Bound methods hoisted out of the loop; rows lacking a key skip straight
+    # to the next one instead of going through .get defaults
+    add_t, add_v = t_utc.append, v.append
+    for p in arr:
         try:
-            # USGS time includes offset, keep as string for JS to parse or simple ISO
-            pts.append((str(t), float(x)))
+            t = p["dateTime"]
+            x = float(p["value"])
         except Exception:
             continue
-    return pts
-
-def get_series_stats(points: List[Tuple[str, float]]) -> Dict[str, Any]:
-    if not points:
+        if t is None:
+            continue
+        # USGS time includes offset, keep as string for JS to parse or simple ISO
+        add_t(str(t))
+        add_v(x)
+    return t_utc, v
+
+def get_series_stats(series: Series) -> Dict[str, Any]:
+    t_utc, v = series
+    if not t_utc:
         return {}
-    # sort by time
-    pts = sorted(points, key=lambda p: p[0])
-    
-    latest = pts[-1]
-    earliest = pts[0]
-    
+    # USGS returns readings in time order; sort (stably) only when it didn't.
+    # sorted() on an already sorted list is a single C-level pass, cheaper than
+    # comparing pairs in Python. The ISO strings order chronologically while
+    # they share one UTC offset; a 7-day window can cross one DST change, and
+    # then its -05:00/-06:00 stamps are compared as parsed instants instead.
+    keys: List[Any] = t_utc
+    if t_utc[0][-6:] != t_utc[-1][-6:]:
+        try:
+            keys = [datetime.fromisoformat(t) for t in t_utc]
+        except ValueError:
+            pass
+    if keys != sorted(keys):
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        t_utc = [t_utc[i] for i in order]
+        v = [v[i] for i in order]
+
     # Calculate delta
-    delta = latest[1] - earliest[1]
+    delta = v[-1] - v[0]
 
     # Columnar format for JS Chart.js performance
-    t_utc = [p[0] for p in pts]
-    v = [p[1] for p in pts]
-
     return {
-        "latest_time": latest[0],
-        "latest_value": latest[1],
-        "earliest_time": earliest[0],
-        "earliest_value": earliest[1],
+        "latest_time": t_utc[-1],
+        "latest_value": v[-1],
+        "earliest_time": t_utc[0],
+        "earliest_value": v[0],
         "delta_7d": delta,
         "series_7d": {
-            "t_utc": t_utc,
-            "v": v
+            "t_utc": t_utc[::SERIES_STEP],
+            "v": v[::SERIES_STEP]
         }
     }
 
-def main() -> int:
-    start_dt = datetime.now(timezone.utc) - timedelta(days=7, hours=6)
+def build_site(key: str, meta: Dict[str, str], time_series: List[dict]) -> Dict[str, object]:
+    site_no = meta["site_no"]
+    print(f"Processing {key} ({site_no})...")
+
+    found: List[Series] = [([], []), ([], [])]  # indexed by SERIES_SLOTS
 
+    for ts in time_series:
+        var = ts.get("variable", EMPTY)
+        code = (var.get("variableCode") or (EMPTY,))[0].get("value")
+        # Strict routing
+        slot = SERIES_SLOTS.get(code)
+        if slot is None:
+            # Fallback only if code didn't match but name does, and only while
+            # no stage series has been found; nothing else gets its rows read
+            name = var.get("variableName", "").lower()
+            if found[0][0] or not ("gage height" in name or "stage" in name):
+                continue
+            slot = 0
+
+        pts = extract_points(ts)
+        if pts[0]:
+            found[slot] = pts
+
+    stage_pts, flow_pts = found
+
+    # 2. Build Site Object
+    site_obj = {
+        "site_no": site_no,
+        "label": meta["label"],
+        "gage_height_ft": get_series_stats(stage_pts),
+        "discharge_cfs": get_series_stats(flow_pts)
+    }
+
+    # Add metadata for "missing" states
+    if not stage_pts[0]:
+        site_obj["gage_height_ft"]["note"] = "Primary stage series missing"
+
+    return site_obj
+
+def main() -> int:
     out: Dict[str, object] = {
         "generated_at_utc": utc_now_iso(),
         "source": {
@@ -108,52 +190,14 @@ def main() -> int:
         "sites": {},
     }
 
+    # 1. Fetch Stage and Discharge explicitly, for every site in one request
+    sites_csv = ",".join(meta["site_no"] for meta in SITES.values())
+    data = fetch_usgs_iv(sites_csv, f"{PARAM_GAGE_HEIGHT},{PARAM_DISCHARGE}")
+    by_site = series_by_site(data)
     for key, meta in SITES.items():
-        site_no = meta["site_no"]
-        print(f"Processing {key} ({site_no})...")
-        
-        # 1. Fetch Stage and Discharge explicitly
-        data = fetch_usgs_iv(site_no, start_dt, f"{PARAM_GAGE_HEIGHT},{PARAM_DISCHARGE}")
-        time_series = data.get("value", {}).get("timeSeries", []) or []
-
-        stage_pts = []
-        flow_pts = []
-        
-        for ts in time_series:
-            var = ts.get("variable", {})
-            code = var.get("variableCode", [{}])[0].get("value")
-            name = var.get("variableName", "").lower()
-            
-            pts = extract_points(ts)
-            if not pts:
-                continue
+        out["sites"][key] = build_site(key, meta, by_site.get(meta["site_no"], []))
 
-            # Strict routing
-            if code == PARAM_GAGE_HEIGHT:
-                stage_pts = pts
-            elif code == PARAM_DISCHARGE:
-                flow_pts = pts
-            elif "gage height" in name or "stage" in name:
-                # Fallback only if code didn't match but name does
-                if not stage_pts: stage_pts = pts
-
-        # 2. Build Site Object
-        site_obj = {
-            "site_no": site_no,
-            "label": meta["label"],
-            "gage_height_ft": get_series_stats(stage_pts),
-            "discharge_cfs": get_series_stats(flow_pts)
-        }
-        
-        # Add metadata for "missing" states
-        if not stage_pts:
-            site_obj["gage_height_ft"]["note"] = "Primary stage series missing"
-        
-        out["sites"][key] = site_obj
-
-    os.makedirs("data", exist_ok=True)
-    with open(OUT_STATUS, "w", encoding="utf-8") as f:
-        json.dump(out, f, indent=2)
+    write_json(OUT_STATUS, out)
 
     print(f"Wrote {OUT_STATUS}")
     return 0
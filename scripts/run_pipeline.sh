@@ -5,6 +5,9 @@ BARGE_RC=0
 RAIL_RC=0
 RISK_RC=0
 
+# Drop HTTP cache entries no run has touched for a while (data/.cache is restored across CI runs)
+python -c "from pipeline_common import prune_cache; prune_cache()" || true
+
 echo "Running river_monitor"
 python river_monitor.py || RIVER_RC=$?
 
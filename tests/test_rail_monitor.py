@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+import rail_monitor
+
+HEADER = "week_end_date,carrier,train_speed_mph,terminal_dwell_hours,source_url,ingested_at_utc\n"
+
+
+class UpdateHistTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "history", "rail_weekly.csv")
+        os.makedirs(os.path.dirname(self.path))
+        patcher = mock.patch.object(rail_monitor, "OUT_HIST", self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_duplicated_stored_key_is_rewritten_without_the_duplicate(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(HEADER)
+            f.write("2025-01-03,BNSF,22.5,24.1,u,t0\n")
+            f.write("2025-01-03,UP,20.0,26.0,u,t0\n")
+            f.write("2025-01-03,UP,21.0,25.0,u,t0\n")  # hand-edited copy of the last row
+        # Re-ingests the stored week, in melt_wide's column order
+        new_df = pd.DataFrame({
+            "week_end_date": ["2025-01-03", "2025-01-03"],
+            "carrier": ["BNSF", "UP"],
+            "terminal_dwell_hours": [24.1, 25.0],
+            "train_speed_mph": [22.5, 21.0],
+            "source_url": ["u", "u"],
+            "ingested_at_utc": ["t1", "t1"],
+        })
+
+        out = rail_monitor.update_hist(new_df)
+
+        stored = pd.read_csv(self.path)
+        self.assertEqual(len(stored), 2)
+        self.assertFalse(stored.duplicated(["week_end_date", "carrier"]).any())
+        up = stored[stored["carrier"] == "UP"].iloc[0]
+        self.assertEqual((up["train_speed_mph"], up["terminal_dwell_hours"]), (21.0, 25.0))
+        # Unchanged weeks keep their stored provenance
+        self.assertEqual(set(stored["ingested_at_utc"]), {"t0"})
+        self.assertEqual(len(out), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()